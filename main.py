@@ -1,14 +1,19 @@
 # main.py
 import os
+import asyncio
+import inspect
 import logging
 import uuid
+from contextlib import asynccontextmanager
 from typing import Any, Dict, Optional, List
 
+from anyio import to_thread
 from fastapi import FastAPI, HTTPException
+from opentelemetry import trace
 from pydantic import BaseModel, Field
 
 from agents import Agent, Runner, function_tool  # Agents SDK :contentReference[oaicite:4]{index=4}
-from pega_client import PegaClient
+from pega_client import PegaClient, start_log_listener, stop_log_listener
 
 
 # --- Logging setup ---
@@ -19,15 +24,38 @@ logging.basicConfig(
 )
 
 logger = logging.getLogger("mcr.agent")
+tracer = trace.get_tracer("mcr.agent")
+
+# Bound concurrent agent runs per worker; excess requests are shed with 503
+MAX_CONCURRENCY = int(os.getenv("MCR_MAX_CONCURRENCY", "16"))
+ACQUIRE_TIMEOUT_S = float(os.getenv("MCR_ACQUIRE_TIMEOUT_S", "0.05"))
+_RUN_SEM = asyncio.Semaphore(MAX_CONCURRENCY)
 
 
 # ----------------------------
 # FastAPI app
 # ----------------------------
-app = FastAPI(title="MCR Agent Service", version="1.0.0")
 pega = PegaClient()
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Only sync endpoints (e.g. /health) use the threadpool; keep it small
+    to_thread.current_default_thread_limiter().total_tokens = int(os.getenv("MCR_THREAD_POOL", "8"))
+
+    # One pooled Pega client per worker; avoids a TCP/TLS handshake per tool call
+    start_log_listener()
+    try:
+        await pega.startup()
+        yield
+    finally:
+        await pega.aclose()
+        stop_log_listener()
+
+
+app = FastAPI(title="MCR Agent Service", version="1.0.0", lifespan=lifespan)
+
+
 @app.get("/health")
 def health():
     return {"ok": True}
@@ -40,8 +68,8 @@ class AgentRunRequest(BaseModel):
     prompt: str
     session_id: Optional[str] = None
     correlation_id: Optional[str] = None
-    # optional context from Pega (user id, ticket, locale, etc.)
-    context: Dict[str, Any] = Field(default_factory=dict)
+    # optional context from Pega (user id, ticket, locale, etc.); None means empty
+    context: Optional[Dict[str, Any]] = None
     # output format: "html" or "json"
     output: str = "html"
 
@@ -57,80 +85,95 @@ class AgentRunResponse(BaseModel):
 # Tool wrappers -> Pega REST services
 # ----------------------------
 # IMPORTANT: These are "thin tools" that call Pega. Pega owns business logic.
+# Each tool is generated from _TOOL_SPECS:
+#   (tool name, description, ((argument, Pega field, required), ...))
+# Arguments mapped to a None field are accepted from the model but not forwarded.
+# Every tool also takes an optional correlation_id.
 
-@function_tool
-async def checking_ticket_eligibility(ticket_number: str, correlation_id: Optional[str] = None) -> Dict[str, Any]:
-    """Call Pega to check if a ticket is eligible for online processing."""
-    return await pega.call_tool(
+_TOOL_SPECS = (
+    (
         "checking_ticket_eligibility",
-        {"ticketNumber": ticket_number},
-        correlation_id=correlation_id,
-    )
-
-@function_tool
-async def checking_ticket_details(ticket_number: str, correlation_id: Optional[str] = None) -> Dict[str, Any]:
-    """Call Pega to fetch ticket details."""
-    return await pega.call_tool(
+        "Call Pega to check if a ticket is eligible for online processing.",
+        (("ticket_number", "ticketNumber", True),),
+    ),
+    (
         "checking_ticket_details",
-        {"ticketNumber": ticket_number},
-        correlation_id=correlation_id,
-    )
-
-@function_tool
-async def creating_plea_online_case(ticket_number: str, plea: str, defendant_email: Optional[str] = None,
-                                   correlation_id: Optional[str] = None) -> Dict[str, Any]:
-    """Call Pega to create a Plea Online case."""
-    return await pega.call_tool(
+        "Call Pega to fetch ticket details.",
+        (("ticket_number", "ticketNumber", True),),
+    ),
+    (
         "creating_plea_online_case",
-        {
-            "ticketNumber": ticket_number,
-            "plea": plea,
-        },
-        correlation_id=correlation_id,
-    )
-
-@function_tool
-async def creating_request_plea_offer_case(ticket_number: str, reason: str, defendant_email: Optional[str] = None,
-                                          correlation_id: Optional[str] = None) -> Dict[str, Any]:
-    """Call Pega to create a Request Plea Offer case."""
-    return await pega.call_tool(
+        "Call Pega to create a Plea Online case.",
+        (
+            ("ticket_number", "ticketNumber", True),
+            ("plea", "plea", True),
+            ("defendant_email", None, False),
+        ),
+    ),
+    (
         "creating_request_plea_offer_case",
-        {
-            "ticketNumber": ticket_number,
-            "reason": reason,
-        },
-        correlation_id=correlation_id,
-    )
-
-@function_tool
-async def initiating_prosecutor_plea_offer_case(ticket_number: str, correlation_id: Optional[str] = None) -> Dict[str, Any]:
-    """Call Pega to initiate prosecutor plea offer workflow."""
-    return await pega.call_tool(
+        "Call Pega to create a Request Plea Offer case.",
+        (
+            ("ticket_number", "ticketNumber", True),
+            ("reason", "reason", True),
+            ("defendant_email", None, False),
+        ),
+    ),
+    (
         "initiating_prosecutor_plea_offer_case",
-        {"ticketNumber": ticket_number},
-        correlation_id=correlation_id,
-    )
-
-@function_tool
-async def show_prosecutor_plea_offer_list(ticket_number: str, correlation_id: Optional[str] = None) -> Dict[str, Any]:
-    """Call Pega to retrieve prosecutor offer list."""
-    return await pega.call_tool(
+        "Call Pega to initiate prosecutor plea offer workflow.",
+        (("ticket_number", "ticketNumber", True),),
+    ),
+    (
         "show_prosecutor_plea_offer_list",
-        {"ticketNumber": ticket_number},
-        correlation_id=correlation_id,
-    )
-
-@function_tool
-async def send_email_with_case_confirmation(case_id: str, to_email: str, correlation_id: Optional[str] = None) -> Dict[str, Any]:
-    """
-    Call Pega to generate/queue an email confirmation.
-    Recommended: Pega returns preview payload (subject/body/template vars) instead of sending directly.
-    """
-    return await pega.call_tool(
+        "Call Pega to retrieve prosecutor offer list.",
+        (("ticket_number", "ticketNumber", True),),
+    ),
+    (
         "send_email_with_case_confirmation",
-        {"caseId": case_id, "toEmail": to_email},
-        correlation_id=correlation_id,
+        "Call Pega to generate/queue an email confirmation.\n"
+        "Recommended: Pega returns preview payload (subject/body/template vars) instead of sending directly.",
+        (
+            ("case_id", "caseId", True),
+            ("to_email", "toEmail", True),
+        ),
+    ),
+)
+
+
+def _make_tool(tool_name: str, description: str, params):
+    fields = tuple((arg, api_name) for arg, api_name, _ in params if api_name)
+
+    async def _tool(**kwargs: Any) -> Dict[str, Any]:
+        return await pega.call_tool(
+            tool_name,
+            {api_name: kwargs[arg] for arg, api_name in fields},
+            correlation_id=kwargs.get("correlation_id"),
+        )
+
+    # Give the Agents SDK a real signature to build the tool's JSON schema from.
+    # Keyword-only, so the SDK passes every argument by name into **kwargs.
+    signature_params = [
+        inspect.Parameter(
+            arg,
+            inspect.Parameter.KEYWORD_ONLY,
+            annotation=str if required else Optional[str],
+            default=inspect.Parameter.empty if required else None,
+        )
+        for arg, _, required in params
+    ]
+    signature_params.append(
+        inspect.Parameter("correlation_id", inspect.Parameter.KEYWORD_ONLY, annotation=Optional[str], default=None)
     )
+    _tool.__name__ = _tool.__qualname__ = tool_name
+    _tool.__doc__ = description
+    _tool.__signature__ = inspect.Signature(signature_params, return_annotation=Dict[str, Any])
+    _tool.__annotations__ = {p.name: p.annotation for p in signature_params}
+    _tool.__annotations__["return"] = Dict[str, Any]
+    return function_tool(_tool)
+
+
+TOOLS = [_make_tool(*spec) for spec in _TOOL_SPECS]
 
 
 # ----------------------------
@@ -164,25 +207,32 @@ agent = Agent(
     name="MCR Tools Agent",
     instructions=AGENT_INSTRUCTIONS,
     model=os.getenv("OPENAI_MODEL", "gpt-5-nano"),
-    tools=[
-        checking_ticket_eligibility,
-        checking_ticket_details,
-        creating_plea_online_case,
-        creating_request_plea_offer_case,
-        initiating_prosecutor_plea_offer_case,
-        show_prosecutor_plea_offer_list,
-        send_email_with_case_confirmation,
-    ],
+    tools=TOOLS,
 )
 
 
+# Per-request preamble; bound once so the hot path is a single %-format call
+_PROMPT_PREFIX = "[correlation_id=%s]\n[output_format=%s]\n".__mod__
+_run = Runner.run
+
+
+_TEXT_ATTRS = ("final_output", "output_text", "final_response", "text")
+# Resolved on the first run result; the installed SDK version can't change at runtime
+_text_attr: Optional[str] = None
+
+
 def _extract_text(run_result) -> str:
     # best-effort across SDK versions
-    for attr in ("final_output", "output_text", "final_response", "text"):
-        if hasattr(run_result, attr):
-            v = getattr(run_result, attr)
-            if isinstance(v, str) and v.strip():
-                return v.strip()
+    global _text_attr
+    if _text_attr is None:
+        _text_attr = next((a for a in _TEXT_ATTRS if hasattr(run_result, a)), None)
+        if _text_attr is None:
+            return str(run_result).strip()
+    v = getattr(run_result, _text_attr, None)
+    if isinstance(v, str):
+        v = v.strip()
+        if v:
+            return v
     return str(run_result).strip()
 
 
@@ -193,6 +243,31 @@ def _extract_text(run_result) -> str:
 async def agent_run(req: AgentRunRequest):
     correlation_id = req.correlation_id or str(uuid.uuid4())
 
+    try:
+        await asyncio.wait_for(_RUN_SEM.acquire(), timeout=ACQUIRE_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        logger.warning(
+            "AGENT RUN REJECTED correlation_id=%s reason=max_concurrency(%s)",
+            correlation_id,
+            MAX_CONCURRENCY,
+        )
+        raise HTTPException(
+            status_code=503,
+            detail="Agent service is at capacity, retry shortly",
+            headers={"Retry-After": "1"},
+        )
+
+    try:
+        with tracer.start_as_current_span(
+            "agent.run",
+            attributes={"correlation_id": correlation_id, "output": req.output},
+        ):
+            return await _agent_run(req, correlation_id)
+    finally:
+        _RUN_SEM.release()
+
+
+async def _agent_run(req: AgentRunRequest, correlation_id: str) -> AgentRunResponse:
     logger.info(
         "AGENT RUN START correlation_id=%s session_id=%s output=%s prompt=%s",
         correlation_id,
@@ -203,15 +278,12 @@ async def agent_run(req: AgentRunRequest):
 
     # Provide correlation_id to the agent via prompt/context.
     # Simplest approach: append it to the prompt and ensure tools accept correlation_id param.
-    prompt = (
-        f"[correlation_id={correlation_id}]\n"
-        f"[output_format={req.output}]\n"
-        f"{req.prompt}"
-    )
+    prompt = _PROMPT_PREFIX((correlation_id, req.output)) + req.prompt
 
     try:
         # Agents SDK built-in loop handles multi-tool sequences :contentReference[oaicite:5]{index=5}
-        rr = await Runner.run(agent, prompt)
+        # (the module-level `agent` is reused across requests; never rebuild it here)
+        rr = await _run(agent, prompt)
         final = _extract_text(rr)
 
         # Optional: extract tool calls if available (varies by SDK version)
@@ -239,3 +311,17 @@ async def agent_run(req: AgentRunRequest):
             repr(e),
         )
         raise HTTPException(status_code=500, detail=f"Agent run failed: {e}")
+
+
+if __name__ == "__main__":
+    # Local entrypoint; "auto" picks uvloop/httptools (from uvicorn[standard]) when
+    # installed and falls back to asyncio/h11 otherwise (e.g. uvloop on Windows)
+    import uvicorn
+
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="auto",
+        http="auto",
+    )
@@ -1,12 +1,88 @@
 # pega_client.py
 import os
+import copy
+import zlib
+import socket
+import asyncio
 import httpx
 import base64
+import orjson
+import queue
 import logging
-from typing import Any, Dict, Optional
+import urllib.parse
+import urllib.request
+import logging.handlers
+from typing import Any, Dict, Optional, Tuple
+
+from cachetools import TTLCache
+from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
 
 logger = logging.getLogger("mcr.pega")
 
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a deterministic fraction of per-call trace logs, bucketed by correlation_id
+    so a sampled run keeps all of its lines. WARNING and above always pass.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.threshold = int(0x10000 * max(0.0, min(rate, 1.0)))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        correlation_id = getattr(record, "correlation_id", None)
+        if not correlation_id:
+            return True
+        # crc32 rather than hash(): stable across workers regardless of PYTHONHASHSEED
+        return (zlib.crc32(correlation_id.encode("utf-8")) & 0xFFFF) < self.threshold
+
+
+logger.addFilter(SamplingFilter(float(os.getenv("PEGA_LOG_SAMPLE", "0.05"))))
+
+# Read-only lookups whose results can be reused for PEGA_CACHE_TTL seconds
+CACHEABLE_TOOLS = frozenset({
+    "checking_ticket_eligibility",
+    "checking_ticket_details",
+    "show_prosecutor_plea_offer_list",
+})
+
+# While the listener runs, mcr.pega records are handed to a queue and a background
+# thread does the stream writes. QueueHandler.prepare() still formats the message
+# (including any payload/body repr) on the calling thread, which is why the body
+# logs are guarded by isEnabledFor(DEBUG). Outside start_log_listener() /
+# stop_log_listener() the logger propagates to the root handlers as usual.
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def start_log_listener() -> None:
+    """Drain queued mcr.pega records into the root logger's handlers."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    handlers = logging.getLogger().handlers or [logging.StreamHandler()]
+    _log_listener = logging.handlers.QueueListener(_log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    logger.addHandler(_log_queue_handler)
+    logger.propagate = False
+
+
+def stop_log_listener() -> None:
+    """Flush any pending records and stop the listener thread."""
+    global _log_listener
+    if _log_listener is None:
+        return
+    listener, _log_listener = _log_listener, None
+    # detach first so nothing is enqueued after the listener drains the queue
+    logger.removeHandler(_log_queue_handler)
+    logger.propagate = True
+    listener.stop()
+
+
 class PegaClient:
     def __init__(self):
         self.base_url = os.environ["PEGA_BASE_URL"].rstrip("/")
@@ -19,15 +95,126 @@ class PegaClient:
         if not self.username or not self.password:
             raise RuntimeError("Missing PEGA_BASIC_USERNAME or PEGA_BASIC_PASSWORD")
 
-    def _headers(self) -> Dict[str, str]:
-        auth_bytes = f"{self.username}:{self.password}".encode("utf-8")
-        auth_b64 = base64.b64encode(auth_bytes).decode("utf-8")
-        return {
+        # Credentials never change for the process lifetime: encode them once
+        auth_b64 = base64.b64encode(f"{self.username}:{self.password}".encode("utf-8")).decode("utf-8")
+        self._auth_header = f"Basic {auth_b64}"
+        self._base_headers: Dict[str, str] = {
             "Accept": "application/json",
             "Content-Type": "application/json",
-            "Authorization": f"Basic {auth_b64}",
+            "Authorization": self._auth_header,
         }
 
+        # Connection pool sizing for concurrent tool fan-out across agent runs
+        self.max_connections = int(os.getenv("PEGA_MAX_CONNECTIONS", "200"))
+        self.max_keepalive = int(os.getenv("PEGA_MAX_KEEPALIVE", "50"))
+        self.keepalive_expiry_s = float(os.getenv("PEGA_KEEPALIVE_EXPIRY", "30"))
+
+        # "httpx" (native pool) or "aiohttp" (aiohttp-backed transport for high fan-out)
+        self.transport = os.getenv("PEGA_HTTP_TRANSPORT", "httpx").lower()
+
+        # Paths relative to base_url (resolved by the shared client), filled on first
+        # use of each tool so main._TOOL_SPECS stays the only list of tool names
+        self._tool_paths: Dict[str, str] = {}
+
+        # Shared connection pool, created in startup() and closed in aclose()
+        self._client: Optional[httpx.AsyncClient] = None
+
+        # TTL cache for CACHEABLE_TOOLS (PEGA_CACHE_TTL=0 disables it), keyed by
+        # ticketNumber -> {(tool, payload): result} so a successful write can drop
+        # everything cached for that ticket in one pop. Buckets are only ever mutated,
+        # never re-assigned, so no entry outlives the bucket's TTL. The cache is per
+        # process: a write only invalidates this worker, and other gunicorn workers can
+        # serve a stale result for up to PEGA_CACHE_TTL.
+        self.cache_ttl_s = int(os.getenv("PEGA_CACHE_TTL", "30"))
+        self._cache: Optional[TTLCache] = (
+            TTLCache(maxsize=4096, ttl=self.cache_ttl_s) if self.cache_ttl_s > 0 else None
+        )
+        # Concurrent identical lookups await one shared task, so they share a single
+        # Pega call and a single failure (raised to every waiter) instead of retrying in turn
+        self._inflight: Dict[Tuple[str, bytes], "asyncio.Task[Any]"] = {}
+
+    def _headers(self) -> Dict[str, str]:
+        # Shared template; httpx copies it into its own Headers, so never mutate it here
+        return self._base_headers
+
+    def _httpx_transport(self, proxy: Optional[str] = None) -> httpx.AsyncBaseTransport:
+        # Pool limits and http2 must live on the transport once one is passed explicitly
+        return httpx.AsyncHTTPTransport(
+            proxy=proxy,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=self.keepalive_expiry_s,
+            ),
+            # Negotiated via ALPN; falls back to HTTP/1.1 if Pega doesn't offer h2
+            http2=True,
+            # Small request/response pairs: disable Nagle, keep idle pooled sockets alive
+            socket_options=[
+                (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ],
+        )
+
+    def _env_proxy(self) -> Optional[str]:
+        # An explicit transport turns off httpx's own env proxy handling. Every call
+        # goes to base_url, so resolve HTTP(S)_PROXY/ALL_PROXY/NO_PROXY for that one
+        # host with the stdlib instead of rebuilding httpx's per-pattern mounts.
+        proxies = urllib.request.getproxies()
+        url = urllib.parse.urlsplit(self.base_url)
+        if url.hostname and urllib.request.proxy_bypass_environment(url.hostname, proxies):
+            return None
+        proxy = proxies.get(url.scheme) or proxies.get("all")
+        if proxy and "://" not in proxy:
+            proxy = f"http://{proxy}"
+        return proxy or None
+
+    def _aiohttp_transport(self) -> httpx.AsyncBaseTransport:
+        # Optional dependency (requirements-aiohttp.txt): only imported when PEGA_HTTP_TRANSPORT=aiohttp
+        # (aiohttp already sets TCP_NODELAY on its connections)
+        import aiohttp
+        from httpx_aiohttp import AiohttpTransport
+
+        return AiohttpTransport(
+            client=lambda: aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections,
+                    limit_per_host=self.max_connections,
+                    keepalive_timeout=self.keepalive_expiry_s,
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout_s),
+                # honour HTTP(S)_PROXY / NO_PROXY like the httpx path
+                trust_env=True,
+            )
+        )
+
+    async def startup(self) -> None:
+        """Open the long-lived HTTP client so tool calls reuse pooled connections."""
+        if self._client is not None:
+            return
+
+        if self.transport == "aiohttp":
+            transport = self._aiohttp_transport()
+        elif self.transport == "httpx":
+            transport = self._httpx_transport(proxy=self._env_proxy())
+        else:
+            raise RuntimeError(f"Unsupported PEGA_HTTP_TRANSPORT: {self.transport}")
+
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self.timeout_s,
+            headers=self._headers(),
+            transport=transport,
+        )
+        # Adds W3C traceparent/tracestate to every outbound Pega request
+        HTTPXClientInstrumentor().instrument_client(self._client)
+
+    async def aclose(self) -> None:
+        """Close the shared HTTP client and release its pooled connections."""
+        if self._client is None:
+            return
+        client, self._client = self._client, None
+        await client.aclose()
+
     async def call_tool(
         self,
         tool_name: str,
@@ -37,42 +224,143 @@ class PegaClient:
         """
         Call the unified Pega tool endpoint:
         POST /mcr/tickets/tools/{tool_name}
+        Read-only tools (CACHEABLE_TOOLS) are served from a short TTL cache.
         """
-        url = f"{self.base_url}/mcr/tickets/tools/{tool_name}"
-        headers = self._headers()
-        if correlation_id:
-            headers["X-Correlation-Id"] = correlation_id
+        if self._client is None:
+            raise RuntimeError("PegaClient.startup() must be awaited before calling tools")
+
+        if self._cache is None:
+            return await self._post(tool_name, payload, correlation_id)
+
+        ticket = payload.get("ticketNumber")
+        if tool_name not in CACHEABLE_TOOLS:
+            try:
+                return await self._post(tool_name, payload, correlation_id)
+            finally:
+                # A write (even one that errored after reaching Pega) may change the
+                # ticket's eligibility/details/offers: drop its cached reads
+                if ticket is not None:
+                    self._cache.pop(ticket, None)
+        if ticket is None:
+            return await self._post(tool_name, payload, correlation_id)
+
+        key = (tool_name, orjson.dumps(payload, option=orjson.OPT_SORT_KEYS))
+        bucket = self._cache.get(ticket)
+        data = bucket.get(key) if bucket is not None else None
+        if data is None:
+            task = self._inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._fetch_cached(ticket, key, tool_name, payload, correlation_id))
+                self._inflight[key] = task
+                task.add_done_callback(lambda t: self._inflight_done(key, t))
+                # shield: a cancelled caller must not cancel the call other waiters share
+                return copy.deepcopy(await asyncio.shield(task))
+            data = await asyncio.shield(task)
+
+        logger.info(
+            "PEGA TOOL CACHE HIT tool=%s correlation_id=%s",
+            tool_name,
+            correlation_id,
+            extra={"correlation_id": correlation_id},
+        )
+        # callers (and the Agents SDK) may mutate the result; never hand out the cached object
+        return copy.deepcopy(data)
+
+    async def _fetch_cached(
+        self,
+        ticket: str,
+        key: Tuple[str, bytes],
+        tool_name: str,
+        payload: Dict[str, Any],
+        correlation_id: Optional[str],
+    ) -> Any:
+        bucket = self._cache.get(ticket)
+        if bucket is None:
+            bucket = self._cache[ticket] = {}
+        data = await self._post(tool_name, payload, correlation_id)
+        # If a write invalidated the ticket meanwhile, this bucket is already
+        # detached from the cache and the result is dropped
+        bucket[key] = data
+        return data
+
+    def _inflight_done(self, key: Tuple[str, bytes], task: "asyncio.Task[Any]") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # mark the exception retrieved even if every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def _post(
+        self,
+        tool_name: str,
+        payload: Dict[str, Any],
+        correlation_id: Optional[str],
+    ) -> Dict[str, Any]:
+        path = self._tool_paths.get(tool_name)
+        if path is None:
+            path = self._tool_paths[tool_name] = f"/mcr/tickets/tools/{tool_name}"
+        # Always send the caller's correlation id; the httpx instrumentation adds
+        # traceparent/tracestate alongside it when a span is active
+        headers = {"X-Correlation-Id": correlation_id} if correlation_id else None
+
+        log_extra = {"correlation_id": correlation_id}
 
         # ---- LOG request ----
         logger.info(
-            "PEGA TOOL REQUEST tool=%s correlation_id=%s url=%s payload=%s",
+            "PEGA TOOL REQUEST tool=%s correlation_id=%s path=%s",
             tool_name,
             correlation_id,
-            url,
-            payload,
+            path,
+            extra=log_extra,
         )
-        
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            resp = await client.post(url, json=payload, headers=headers)
+        # payload repr only built when DEBUG is on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "PEGA TOOL REQUEST BODY tool=%s correlation_id=%s payload=%s",
+                tool_name,
+                correlation_id,
+                payload,
+                extra=log_extra,
+            )
 
-            # ---- LOG response status ----
-            logger.info(
-                "PEGA TOOL RESPONSE tool=%s correlation_id=%s status=%s",
+        # Content-Type: application/json is already set on the client
+        resp = await self._client.post(path, content=orjson.dumps(payload), headers=headers)
+
+        # ---- LOG response status ----
+        # (errors are logged at WARNING so sampling never drops them; the
+        # HTTPStatusError is only built on that branch, not on every success)
+        if not resp.is_success:
+            logger.warning(
+                "PEGA TOOL RESPONSE tool=%s correlation_id=%s status=%s http_version=%s",
                 tool_name,
                 correlation_id,
                 resp.status_code,
+                resp.http_version,
+                extra=log_extra,
             )
-
             resp.raise_for_status()
-            data = resp.json()
 
-            # ---- LOG a small summary of response ----
-            # (Avoid logging huge or super-sensitive data in production)
+        logger.info(
+            "PEGA TOOL RESPONSE tool=%s correlation_id=%s status=%s http_version=%s",
+            tool_name,
+            correlation_id,
+            resp.status_code,
+            resp.http_version,
+            extra=log_extra,
+        )
+
+        # resp.content is the already-decompressed body; parse the bytes directly
+        data = orjson.loads(resp.content)
+
+        # ---- LOG a small summary of response ----
+        # (Avoid logging huge or super-sensitive data in production)
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(
                 "PEGA TOOL RESPONSE BODY tool=%s correlation_id=%s body=%s",
                 tool_name,
                 correlation_id,
                 data,
+                extra=log_extra,
             )
 
-            return data
+        return data